@@ -1,45 +1,124 @@
-import random
+import os
+import pickle
+import selectors
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from multiprocessing import Process, Queue, cpu_count
-from threading import Lock, Thread
-from time import sleep
+from multiprocessing import Process, get_context
+from threading import Condition, Event, RLock, Thread
+from time import monotonic, sleep
 from typing import Self
 
 import psutil as ps
 
+# 进程池本体就是线程，smart模式还会再开一个监视线程
+# 直接fork一个多线程的父进程有死锁风险（别的线程正拿着的锁会被一起fork走）
+# CPython 3.12起也会为此告警
+# forkserver从一个干净的单线程服务进程fork，既安全又省掉spawn重新导入解释器的开销
+try:
+    _mp_ctx = get_context("forkserver")
+except ValueError:
+    _mp_ctx = get_context()
 
-class CirnoProcess(Process):
+# fork下任务参数靠COW共享，零拷贝
+# spawn类平台会把进程对象整个重新pickle，提交时就序列化成一个blob
+# 只pickle一次，子进程再loads回来
+_PREPICKLE = _mp_ctx.get_start_method() != "fork"
+
+
+# 哨兵值，用来区分"还没有结果"和"结果恰好是None"
+_UNSET = object()
+
+
+def _default_cpus() -> int:
+    # 容器/cgroup里亲和性掩码才是真正可用的核数，cpu_count()会虚报
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class CirnoBackpressure(Exception):
+    """
+    等待队列满了，而且在限定时间内也没等到空位
+    """
+
+
+class CirnoRemoteException(Exception):
+    """
+    包装子进程里抛出的异常
+    保留原始异常的类型名、参数和完整的traceback文本
+    """
+
+    def __init__(self, type_name: str, exc_args: tuple, tb_str: str) -> None:
+        super().__init__(type_name, exc_args)
+        self.type_name: str = type_name
+        self.exc_args: tuple = exc_args
+        self.tb_str: str = tb_str
+
+    def __str__(self) -> str:
+        return self.tb_str
+
+
+class CirnoProcess(_mp_ctx.Process):
     """
     用于表示进程上执行的任务的对象
     """
 
     def __init__(self, func: callable, *args, **kwargs) -> None:
         super().__init__()
-        self._func: callable = func
-        self._c_args = args
-        self._c_kwargs = kwargs
-        self._result: None | object = None
-        self._expection: None | BaseException = None
+        self._task: None | tuple = None
+        self._payload: None | bytes = None
+        if _PREPICKLE:
+            self._payload = pickle.dumps(
+                (func, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL
+            )
+        else:
+            self._task = (func, args, kwargs)
+        self._result: object = _UNSET
+        self._expection: object = _UNSET
         # pipe between parent with child
-        self._result_pipe = None
-        self._expection_pipe = None
+        self._conn_parent = None
+        self._conn_child = None
         # monitor
         self._ps_process: None | ps.Process = None
+        self._last_runtime: (float, float) = (0, 0)
 
         self._is_closed: bool = False
 
         self._attched_future: None | CirnoFuture = None
 
     def start(self) -> None:
-        self._result_pipe = Queue()
-        self._expection_pipe = Queue()
+        self._conn_parent, self._conn_child = _mp_ctx.Pipe(duplex=False)
         super().start()
+        # 父进程这边用不到写端，及时关掉以免fd泄漏
+        self._conn_child.close()
+        self._conn_child = None
+
+    def _load_task(self) -> tuple:
+        if self._task is not None:
+            return self._task
+        return pickle.loads(self._payload)
 
     def run(self) -> None:
+        # 子进程只发一条 (是否成功, 结果或异常) 的消息
+        # 只拦Exception，KeyboardInterrupt/SystemExit让子进程照常退出
         try:
-            self._result_pipe.put(self._func(*self._c_args, **self._c_kwargs))
-        except BaseException as e:
-            self._expection_pipe.put(e)
+            func, args, kwargs = self._load_task()
+            self._conn_child.send((True, func(*args, **kwargs)))
+        except Exception as e:
+            # traceback对象不可pickle，在边界上转成文本
+            tb_str = "".join(traceback.format_exception(e))
+            try:
+                self._conn_child.send((False, (type(e).__name__, e.args, tb_str)))
+            except Exception:
+                # 异常参数本身不可pickle时退化为repr
+                self._conn_child.send(
+                    (False, (type(e).__name__, (repr(e.args),), tb_str))
+                )
+        finally:
+            self._conn_child.close()
 
     def close(self, force: bool = True) -> None:
         if self._is_closed is True:
@@ -53,17 +132,14 @@ class CirnoProcess(Process):
 
         self._is_closed = True
 
-        if self._result_pipe.empty() is False:
-            self._result = self._result_pipe.get()
-        if self._expection_pipe.empty() is False:
-            self._expection = self._expection_pipe.get()
+        self._recv_result()
+        if self._conn_parent is not None:
+            self._conn_parent.close()
 
-        del self._result_pipe
-        del self._expection_pipe
+        del self._conn_parent
         del self._ps_process
 
-        self._result_pipe = None
-        self._expection_pipe = None
+        self._conn_parent = None
         self._ps_process = None
         super().close()
 
@@ -71,15 +147,33 @@ class CirnoProcess(Process):
         if self._is_closed:
             return
         # 使用psutil 来关闭所有子进程
-        parent = ps.Process(self.pid)
-        for child in parent.children(recursive=True):
-            child.terminate()
-        parent = None
+        # 有现成的句柄就复用，省一次 /proc 扫描
+        try:
+            if self._ps_process is None:
+                self._ps_process = ps.Process(self.pid)
+            for child in self._ps_process.children(recursive=True):
+                child.terminate()
+        except ps.NoSuchProcess:
+            # 进程刚好自己退出了，没有孩子要收
+            pass
         super().terminate()
 
-    def _set_future(self, future: "CirnoFuture") -> None:
-        self._attched_future = future
-        self._attched_future._set_process(self)
+    def _recv_result(self) -> None:
+        # 非阻塞地取回子进程发来的唯一一条消息
+        if self._conn_parent is None:
+            return
+        if self._conn_parent.poll():
+            # 被terminate的子进程只留下一个EOF，不算有消息
+            try:
+                ok, val = self._conn_parent.recv()
+            except (EOFError, OSError):
+                return
+            if ok:
+                self._result = val
+            else:
+                # 在父进程这边重建异常
+                type_name, exc_args, tb_str = val
+                self._expection = CirnoRemoteException(type_name, exc_args, tb_str)
 
     def reborn(self) -> None | Self:
         """
@@ -88,18 +182,19 @@ class CirnoProcess(Process):
         if self._is_closed is False:
             return None
         # 新建
-        new = CirnoProcess(self._func, *self._c_args, **self._c_kwargs)
+        func, args, kwargs = self._load_task()
+        new = CirnoProcess(func, *args, **kwargs)
         if self._attched_future is not None:
-            new._set_future(self._attched_future)
+            # 把future重新绑到重生的进程上
+            new._attched_future = self._attched_future
+            self._attched_future._process = new
 
         return new
 
     def get_future(self) -> "CirnoFuture":
-        if self._attched_future is not None:
-            self._attched_future._set_process(self)
-            return self._attched_future
-        # 新建一个Future 并返回
-        self._attched_future = CirnoFuture(self)
+        # 懒创建，之后直接返回同一个Future
+        if self._attched_future is None:
+            self._attched_future = CirnoFuture(self)
         return self._attched_future
 
     @property
@@ -108,72 +203,82 @@ class CirnoProcess(Process):
         返回进程的调用结果
         如果进程抛出了一个异常，那么其也会抛出其异常
         """
-        if self._is_closed:
-            if self._expection is None:
-                return self._result
-            else:
-                raise self._expection
+        # Cache
+        # 检查是否已经收到过结果或异常
+        if self._result is not _UNSET:
+            return self._result
+        if self._expection is not _UNSET:
+            raise self._expection
 
-        # 进程还在执行时，返回None
-        if self.is_alive():
+        # 关闭后也什么都没收到，那就是真没有
+        if self._is_closed:
             return None
 
-        # Cache
-        # 检查是否有异常
-        if self._expection is not None:
+        # 先看看管道里有没有消息，免得错过已经算完的结果
+        self._recv_result()
+        if self._expection is not _UNSET:
             raise self._expection
-
-        # 检查是否已经调用过结果
-        if self._result is not None:
+        if self._result is not _UNSET:
             return self._result
 
-        if self._expection_pipe.empty():
-            if self._result_pipe.empty():
-                return None
-            else:
-                self._result = self._result_pipe.get()
-                return self._result
-        else:
-            self._expection = self._expection_pipe.get()
-            raise self._expection
+        # 进程还在执行时，返回None
+        return None
 
     @property
     def expection(self) -> None | BaseException:
         """
         返回进程的所抛出的异常
         """
-        # 进程已经被关闭
-        if self._is_closed:
+        # Cache
+        if self._expection is not _UNSET:
             return self._expection
 
-        # 进程还在执行时，返回None
-        if self.is_alive():
+        # 正常收到了结果，或者关闭后也没收到消息，都没有异常
+        if self._result is not _UNSET or self._is_closed:
             return None
 
-        if self._expection is not None:
+        self._recv_result()
+        if self._expection is not _UNSET:
             return self._expection
+        return None
 
-        if self._expection_pipe.empty():
-            return None
-        else:
-            self._expection = self._expection_pipe.get()
-            return self._expection
+    def _sample_runtime(self, prime: bool = False) -> None:
+        # worker随时可能在检查和读取之间退出或被close
+        # 采样失败就跳过这一个，不能把调用方（监视线程）带走
+        try:
+            if self._is_closed or self.pid is None or self.is_alive() is False:
+                return
+
+            if self._ps_process is None:
+                self._ps_process = ps.Process(self.pid)
+                # 第一次调用只是建立基准，返回值没有意义
+                self._ps_process.cpu_percent(interval=None)
+                return
+
+            if prime:
+                # 只刷新基准，不动缓存
+                # 不然近似0的窗口会算出一个假的0%盖掉上次的真值
+                self._ps_process.cpu_percent(interval=None)
+                return
+
+            # 非阻塞采样，返回自上次调用以来的值
+            # oneshot让psutil一次读完 /proc/<pid>/ 下要用的文件并缓存
+            # 而不是cpu和内存各开各读一遍
+            with self._ps_process.oneshot():
+                self._last_runtime = (
+                    self._ps_process.cpu_percent(interval=None),
+                    self._ps_process.memory_percent(),
+                )
+        except (ps.NoSuchProcess, ps.ZombieProcess, ValueError):
+            return
 
     @property
     def runtime_info(self) -> (float, float):
         if self._is_closed or self.pid is None or self.is_alive() is False:
             return (0, 0)
 
-        memory_usage = 0
-        cpu_usage = 0
-
-        if self._ps_process is None:
-            self._ps_process = ps.Process(self.pid)
-
-        memory_usage = self._ps_process.memory_percent()
-        cpu_usage = self._ps_process.cpu_percent(interval=0.2)
-
-        return (cpu_usage, memory_usage)
+        self._sample_runtime()
+        return self._last_runtime
 
 
 class CirnoFuture:
@@ -181,17 +286,26 @@ class CirnoFuture:
     包装类，包装了进程的结果
     """
 
-    def __init__(self, process: CirnoProcess) -> None:
+    def __init__(self, process: None | CirnoProcess) -> None:
         self._process = process
+        # inline任务不经过进程，结果直接写在future上
+        self._preset_result: object = _UNSET
+        self._preset_expection: object = _UNSET
 
     @property
     def result(self) -> None | object:
+        if self._preset_result is not _UNSET:
+            return self._preset_result
+        if self._preset_expection is not _UNSET:
+            raise self._preset_expection
         if self._process is None:
             return None
         return self._process.result
 
     @property
     def expection(self) -> None | BaseException:
+        if self._preset_expection is not _UNSET:
+            return self._preset_expection
         if self._process is None:
             return None
         return self._process.expection
@@ -199,15 +313,15 @@ class CirnoFuture:
     @property
     def is_running(self) -> bool:
         if self._process is None:
-            return False
+            # inline任务，写入结果前都算在跑
+            return (
+                self._preset_result is _UNSET and self._preset_expection is _UNSET
+            )
         if self._process._is_closed:
             return False
         else:
             return self._process.is_alive()
 
-    def _set_process(self, process: CirnoProcess) -> None:
-        self._process = process
-
 
 class CirnoPool(Thread):
     """
@@ -225,185 +339,348 @@ class CirnoPool(Thread):
 
     def __init__(
         self,
-        max_process: int = cpu_count(),
+        max_process: None | int = None,
         is_smart: bool = True,
         min_threshold: (float, float) = (80, 80),
         max_threshold: (float, float) = (95, 95),
         sleep_timeout: int = 9,
+        todo_maxsize: None | int = None,
+        monitor_interval: float = 1.0,
     ) -> None:
         """
-        max_process: int, 设置进程池支持的最大进程数
+        max_process: None | int, 设置进程池支持的最大进程数，默认为可用的核数
         is_smart: bool, 设置进程池是否在运行时和琪露诺一样智能的调整运行的进程
         threshold: (float, float), 代表 CPU(%) 和 MEM(%) 的限制值，但最终可能超过这个值
+        todo_maxsize: None | int, 等待队列的上限，默认为 max_process * 8
+        队列满时submit会阻塞，给过快的生产者施加背压
+        monitor_interval: float, 监视线程采样系统状态的间隔，和sleep_timeout互相独立
         """
         super().__init__()
-        self._max_process: int = max_process
+        self._max_process: int = (
+            max_process if max_process is not None else _default_cpus()
+        )
         self._is_smart: bool = is_smart
 
         self._shutdown: bool = False
         self._is_closed: bool = False
 
         self._now_process: int = 0
-        self._todo_process_list: list[Process] = list()
-        self._now_process_list: list[Process] = list()
-        self._done_process_list: list[Process] = list()
-        self._now_process_lock: Lock = Lock()
-        self._todo_process_lock: Lock = Lock()
-        self._done_process_lock: Lock = Lock()
+        self._todo_process_list: deque[Process] = deque()
+        self._now_process_list: deque[Process] = deque()
+        self._done_process_list: deque[Process] = deque()
+        self._todo_maxsize: int = (
+            todo_maxsize if todo_maxsize is not None else self._max_process * 8
+        )
+
+        # 一把可重入锁保护所有调度状态，每个tick只进一次临界区
+        self._state_lock: RLock = RLock()
+        # 等待队列有空位时通知，submit靠它等待而不是轮询
+        self._not_full: Condition = Condition(self._state_lock)
+        # 状态变化时通知，close()靠它等所有任务做完
+        self._state_cv: Condition = Condition(self._state_lock)
+        # 子进程退出时sentinel变为可读，调度循环等它而不是逐个is_alive轮询
+        self._sel = selectors.DefaultSelector()
+        # 自管道，submit/shutdown用它把等在selector上的循环叫醒
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._sel.register(self._wakeup_r, selectors.EVENT_READ, data=None)
+        # 检查很贵，只在状态变了或者隔了足够久之后才重新采样
+        self._needs_check: Event = Event()
+        self._last_check_ts: float = 0.0
+        self._check_min_interval: float = 1.0
+        self._last_check_result: CirnoPool.Status = self.Status.MaybeOK
 
         self._min_threshold: (float, float) = min_threshold
         self._max_threshold: (float, float) = max_threshold
 
         self._sleep_timeout = sleep_timeout
 
+        # inline任务用的线程池，第一次用到时才创建
+        self._inline_executor: None | ThreadPoolExecutor = None
+
+        # 建立系统CPU采样的基准
+        ps.cpu_percent(interval=None)
+
+        # 系统状态由单独的监视线程采样
+        # 调度线程只读快照，永远不会被采样卡住
+        self._monitor_interval: float = monitor_interval
+        self._snapshot: (float, float, float) = (0.0, 0.0, 0.0)
+        if self._is_smart:
+            self._monitor_thread = Thread(target=self._monitor_loop, daemon=True)
+            self._monitor_thread.start()
+
         # 进程池，启动！
         self.start()
 
-    def submit(self, func: callable, *args, **kwargs) -> CirnoFuture:
+    def submit(
+        self,
+        func: callable,
+        *args,
+        inline: bool = False,
+        timeout: None | float = None,
+        **kwargs,
+    ) -> CirnoFuture:
+        """
+        inline: bool, 对轻任务可以设为True
+        不fork新进程而是在线程里跑，省掉整个解释器的启动开销
+        timeout: None | float, 等待队列满时最多等多久
+        超时了就抛CirnoBackpressure，默认一直等
+        """
         if self._shutdown:
             raise Exception("CirnoPool has closed")
 
+        if inline:
+            return self._submit_inline(func, args, kwargs)
+
         p = CirnoProcess(func, *args, **kwargs)
-        # 将这个进程加入到todolist
-        self._todo_process_lock.acquire()
-        self._todo_process_list.append(p)
-        self._todo_process_lock.release()
+        # 将这个进程加入到todolist，满了就等空位
+        with self._not_full:
+            if not self._not_full.wait_for(
+                lambda: len(self._todo_process_list) < self._todo_maxsize,
+                timeout=timeout,
+            ):
+                raise CirnoBackpressure("todo queue is full")
+            self._todo_process_list.append(p)
+        # 叫醒调度循环
+        self._needs_check.set()
+        self._wake_scheduler()
 
         return p.get_future()
 
+    def _submit_inline(self, func: callable, args: tuple, kwargs: dict) -> CirnoFuture:
+        # 线程池按需创建，不用inline就一点开销没有
+        with self._state_lock:
+            if self._inline_executor is None:
+                self._inline_executor = ThreadPoolExecutor(
+                    max_workers=self._max_process,
+                    thread_name_prefix="cirno-inline",
+                )
+
+        fut = CirnoFuture(None)
+
+        def _run() -> None:
+            try:
+                fut._preset_result = func(*args, **kwargs)
+            except Exception as e:
+                fut._preset_expection = e
+
+        self._inline_executor.submit(_run)
+        return fut
+
     def shutdown(self) -> None:
         self._shutdown = True
+        self._wake_scheduler()
+
+    def _wake_scheduler(self) -> None:
+        # 往自管道里丢一个字节，唤醒等在selector上的调度循环
+        try:
+            os.write(self._wakeup_w, b"\0")
+        except (BlockingIOError, OSError):
+            # 管道满了说明早就有人叫过了，关了说明循环已经退出
+            pass
 
     def close(self) -> None:
         if not self._shutdown:
             raise Exception("You should call shutdown() before close()")
 
-        while True:
-            total_undo = 0
-            self._todo_process_lock.acquire()
-            total_undo += len(self._todo_process_list)
-            self._todo_process_lock.release()
+        # 等待做完的通知，不再傻睡；超时只是兜底，醒来会重查条件
+        with self._state_cv:
+            while not self._state_cv.wait_for(
+                lambda: len(self._todo_process_list) + self._now_process == 0,
+                timeout=self._sleep_timeout,
+            ):
+                pass
 
-            self._now_process_lock.acquire()
-            total_undo += self._now_process
-            self._now_process_lock.release()
+        # 把inline任务也收个尾
+        if self._inline_executor is not None:
+            self._inline_executor.shutdown(wait=True)
 
-            if total_undo == 0:
-                break
-            sleep(self._sleep_timeout)
         self._is_closed = True
+        # 让调度线程尽快退出
+        self._wake_scheduler()
 
     def run(self) -> None:
         while not self._is_closed:
-            ready_to_move: list[Process] = list()
-            self._now_process_lock.acquire()
-            # 检查现在运行的进程是否有终止的
-            for p in self._now_process_list:
-                if p.is_alive() is False:
-                    ready_to_move.append(p)
-            self._now_process_lock.release()
-
-            # 移出这个进程
-            self._move_to_done(ready_to_move)
+            # 等子进程退出(sentinel可读)或者有人来叫，不再逐个is_alive轮询
+            events = self._sel.select(timeout=self._sleep_timeout)
+            done: list[Process] = []
+            for key, _ in events:
+                if key.data is None:
+                    # 只是来叫醒的，把自管道清空
+                    os.read(self._wakeup_r, 4096)
+                    continue
+                # 有进程跑完了
+                self._sel.unregister(key.fileobj)
+                done.append(key.data)
+            # 这一批一起收，一次锁、一次通知，join/close都在锁外
+            if done:
+                self._move_to_done(done)
 
             # 检查
             result = self._cirno_check()
-            if result is self.Status.MaybeOK:
-                # 暂时没事 先睡一会
-                sleep(self._sleep_timeout)
-                continue
             if result is self.Status.Healthy:
                 # 前景大好，干点事
                 # 挑选一个进程进入线程池
                 self._move_to_run()
-                # 好累，睡会
-                sleep(self._sleep_timeout)
-                continue
-            if result is self.Status.Bad:
+                with self._state_lock:
+                    if self._todo_process_list:
+                        # 队列里还有活，别傻等下一次超时
+                        self._wake_scheduler()
+            elif result is self.Status.Bad:
                 # 好像要寄了
                 # 挑选一个任务暂时的结束
                 self._move_to_todo()
-                # 睡会再看看
-                sleep(self._sleep_timeout)
-                continue
+            # MaybeOK: 暂时没事，回到selector上等着
+
+        # 调度循环退出，收拾自己的fd
+        # fd号换成-1，迟到的_wake_scheduler只会拿到OSError
+        # 而不是往一个已经被别人复用的fd里写
+        self._sel.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+        self._wakeup_r = -1
+        self._wakeup_w = -1
+
+    @property
+    def max_process(self) -> int:
+        return self._max_process
 
     @property
     def now_process(self) -> int:
-        self._now_process_lock.acquire()
-        res = self._now_process
-        self._now_process_lock.release()
-        return res
+        with self._state_lock:
+            return self._now_process
 
     def _move_to_todo(self) -> None:
         # 挑选一个进程回收
         # 这里假设self._now_process_list是顺序的，即末尾的是后加入的
         # 所以回收后加入的
-        self._now_process_lock.acquire()
-        if len(self._now_process_list) <= 1:
-            # 只有一个进程了，还是得继续跑吧？
-            self._now_process_lock.release()
-            return
-
-        last_one: CirnoProcess = self._now_process_list[-1]
-        # 结束进程
-        # 移出真正运行列表
-        self._now_process_list.remove(last_one)
-        # 修改计数器
-        self._now_process -= 1
-        self._now_process_lock.release()
-        # 结束进程
-        last_one.terminate()
+        with self._state_lock:
+            if len(self._now_process_list) <= 1:
+                # 只有一个进程了，还是得继续跑吧？
+                return
+
+            last_one: CirnoProcess = self._now_process_list[-1]
+            # 不管是回收还是按完成处理，都不再需要selector的通知
+            self._sel.unregister(last_one.sentinel)
+            if last_one.is_alive() is False:
+                # 它其实已经跑完了，按完成处理，别白白terminate再重跑一遍
+                self._move_to_done([last_one])
+                return
+
+            # 结束进程
+            # 移出真正运行列表
+            self._now_process_list.pop()
+            # 修改计数器
+            self._now_process -= 1
+            pid = last_one.pid
+
+        # 在锁外结束进程
+        # 进程可能在放锁之后刚好退出，别对着复用的PID发信号
+        if pid is not None and ps.pid_exists(pid):
+            last_one.terminate()
         last_one.join()
         last_one.close()
 
         # 重新加入todolist
+        # 内部的重生不受todo_maxsize限制，调度线程不能被背压卡住
         new_one = last_one.reborn()
-        self._todo_process_lock.acquire()
-        self._todo_process_list.append(new_one)
-        self._todo_process_lock.release()
+        with self._state_lock:
+            self._todo_process_list.append(new_one)
 
     def _move_to_run(self) -> None:
-        # 检查是否为空
-        self._todo_process_lock.acquire()
-        if len(self._todo_process_list) == 0:
-            self._todo_process_lock.release()
+        with self._state_lock:
+            # 检查是否为空，满员了也不再硬塞
+            if len(self._todo_process_list) == 0:
+                return
+            if self._now_process >= self._max_process:
+                return
+
+            # 先来后到，先提交的先跑，调度行为也因此可预测
+            lucky_one = self._todo_process_list.popleft()
+            # 空出位置了，告诉可能在等的submit
+            self._not_full.notify()
+
+            # 加入运行列表
+            self._now_process_list.append(lucky_one)
+            # 修改计数器
+            self._now_process += 1
+
+        # 在锁外启动
+        # forkserver下start()可能失败（比如脚本没有__main__保护）
+        # 不能让异常带走调度线程，回滚簿记，把错误交给future
+        try:
+            lucky_one.start()
+        except Exception as e:
+            with self._state_lock:
+                self._now_process_list.remove(lucky_one)
+                self._now_process -= 1
+                self._done_process_list.append(lucky_one)
+                self._state_cv.notify_all()
+            lucky_one._expection = e
             return
-
-        # 挑选幸运儿
-        lucky_one = random.choice(self._todo_process_list)
-        # 移出原列表
-        self._todo_process_list.remove(lucky_one)
-        self._todo_process_lock.release()
-
-        # 加入运行列表
-        self._now_process_lock.acquire()
-        self._now_process_list.append(lucky_one)
-        # 修改计数器
-        self._now_process += 1
-        self._now_process_lock.release()
-        # 启动
-        lucky_one.start()
+        # 子进程退出时sentinel变为可读，挂到selector上等通知
+        self._sel.register(lucky_one.sentinel, selectors.EVENT_READ, data=lucky_one)
 
     def _move_to_done(self, process_list: None | list[Process]) -> None:
         if process_list is None:
             return
 
-        # 将进程移出正在运行的队列
-        self._now_process_lock.acquire()
-        for p in process_list:
-            self._now_process_list.remove(p)
-
-        # 调整计数器
-        self._now_process -= len(process_list)
-        self._now_process_lock.release()
-
-        # 将这些进程关闭，并移入完成列表
-        self._done_process_lock.acquire()
+        with self._state_lock:
+            # 一趟扫描将进程移出正在运行的队列，避免N次remove
+            moved = set(id(p) for p in process_list)
+            self._now_process_list = deque(
+                p for p in self._now_process_list if id(p) not in moved
+            )
+
+            # 调整计数器
+            self._now_process -= len(process_list)
+            # 移入完成列表
+            self._done_process_list.extend(process_list)
+            # 通知等在close()里的人重查一下条件
+            self._state_cv.notify_all()
+
+        # 有槽位空出来了，让调度循环马上再看一眼
+        self._needs_check.set()
+        self._wake_scheduler()
+
+        # 在锁外关闭这些进程
         for p in process_list:
             p.join()
             p.close()
-            self._done_process_list.append(p)
-        self._done_process_lock.release()
+
+    def _sample_all_runtime(self, interval: float = 0.2) -> None:
+        """
+        一趟采样所有运行中的进程
+        N个进程总共只睡一个采样窗口，而不是每个进程各睡一次
+        """
+        with self._state_lock:
+            procs = list(self._now_process_list)
+
+        # 第一遍建立基准（没有基准的进程这一遍只是准备）
+        for p in procs:
+            p._sample_runtime(prime=True)
+        # 公共的采样窗口
+        sleep(interval)
+        # 第二遍读取自基准以来的值，结果缓存在各进程上
+        for p in procs:
+            p._sample_runtime()
+
+    def _monitor_loop(self) -> None:
+        while not self._is_closed:
+            # 一次采样失败不至于让监视线程去世，歇一拍再来
+            # 不然快照从此冻结，smart模式会一直按过期数字做决定
+            try:
+                os_mem = ps.virtual_memory()
+                total_cpu = ps.cpu_percent(interval=None)
+                total_mem = (os_mem.used / os_mem.total) * 100
+                # CPython里元组赋值是原子的，读快照的人不用加锁
+                self._snapshot = (total_cpu, total_mem, monotonic())
+                # 顺便批量采样各个worker
+                # 里面的采样窗口同时就是本循环的间隔
+                self._sample_all_runtime(self._monitor_interval)
+            except Exception:
+                sleep(self._monitor_interval)
 
     def _cirno_check(self) -> Status:
         """
@@ -418,18 +695,31 @@ class CirnoPool(Thread):
             else:
                 return self.Status.MaybeOK
 
+        # 状态没变且距离上次检查还不够久，直接用上次的结论
+        # 已经满员时缓存的Healthy不作数，不然会一路冲过max_process
+        now = monotonic()
+        if (
+            self._needs_check.is_set() is False
+            and now - self._last_check_ts < self._check_min_interval
+        ):
+            if self._now_process >= self._max_process:
+                return self.Status.MaybeOK
+            return self._last_check_result
+        self._needs_check.clear()
+        self._last_check_ts = now
+
         # 进行运行时的环境检查以查看是否能继续增加一个进程
-        os_mem = ps.virtual_memory()
-        total_cpu = ps.cpu_percent(interval=0.2)
-        total_mem = (os_mem.used / os_mem.total) * 100
+        # 只读监视线程维护的快照，不在调度线程里采样
+        total_cpu, total_mem, _ = self._snapshot
 
         if total_cpu >= self._max_threshold[0] or total_mem >= self._max_threshold[1]:
-            return self.Status.Bad
-
-        if self._now_process == self._max_process:
-            return self.Status.MaybeOK
-
-        if total_cpu < self._min_threshold[0] and total_mem < self._min_threshold[1]:
-            return self.Status.Healthy
+            result = self.Status.Bad
+        elif self._now_process == self._max_process:
+            result = self.Status.MaybeOK
+        elif total_cpu < self._min_threshold[0] and total_mem < self._min_threshold[1]:
+            result = self.Status.Healthy
+        else:
+            result = self.Status.MaybeOK
 
-        return self.Status.MaybeOK
+        self._last_check_result = result
+        return result